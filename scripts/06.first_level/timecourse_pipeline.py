@@ -5,7 +5,8 @@ Adapted script from original notebook:
 https://github.com/poldrack/fmri-analysis-vm/blob/master/analysis/postFMRIPREPmodelling/First%20and%20Second%20Level%20Modeling%20(FSL).ipynb
 
 More information on what this script is doing - beyond the commented code - is provided on the lab's github wiki page
-Nesting of functions: main > argparser > process_subject > create_timecourse_workflow > data_grabber > process_data_files > denoise_data > extract_timecourse
+Nesting of functions: main > argparser > process_subject > create_timecourse_workflow > data_grabber > process_data_files > smooth_data > denoise_data > extract_timecourse
+Node functions are defined at module level; nipype runs each from its source, so they keep their own imports
 
 Requirement: BIDS dataset (including events.tsv), derivatives directory with fMRIPrep outputs, and modeling files
 
@@ -13,20 +14,673 @@ Requirement: BIDS dataset (including events.tsv), derivatives directory with fMR
 from nipype.interfaces import fsl
 from nipype import Workflow, Node, IdentityInterface, Function, DataSink, JoinNode, MapNode
 import nilearn
+# imported here (as well as in the node functions) so MultiProc workers inherit them already loaded
+from nilearn import image
+import nibabel as nib
 import os
 import os.path as op
 import numpy as np
 import argparse
-from bids.layout import BIDSLayout
-from niflow.nipype1.workflows.fmri.fsl import create_susan_smooth
 import pandas as pd
 import glob
 import shutil
 from datetime import datetime
+from functools import lru_cache
+from scipy.signal import butter
+
+# define function to design the butterworth high pass filter (cached because TR and hpf are typically the same for every subject and run)
+@lru_cache(maxsize=8)
+def highpass_sos(TR, hpf, order=5):
+    # convert filter from seconds to Hz and return second-order sections for sosfiltfilt
+    return butter(order, 1/hpf, btype='highpass', fs=1.0/TR, output='sos')
+
+# define data grabber function
+def data_grabber(sub, task, mask_opts, sharedDir, projDir, derivDir, resultsDir, smoothDir, subDir, template, dropvols, ses, multiecho, run_id, splithalf_id, space_name):
+    """Quick filegrabber ala SelectFiles/DataGrabber"""
+    import os
+    import os.path as op
+    import glob
+    import shutil
+    from nibabel import load
+
+    # define output filename and path, depending on whether session information is in directory/file names
+    if ses != 'no': # if session was provided
+        # define path to preprocessed functional and mask data (subject derivatives func folder)
+        prefix = 'sub-{}_ses-{}_task-{}'.format(sub, ses, task)
+        funcDir = op.join(derivDir, 'sub-{}'.format(sub), 'ses-{}'.format(ses), 'func')
+        mni_mask = op.join(funcDir, 'sub-{}_ses-{}_space-{}_desc-brain_mask_allruns-BOLDmask.nii.gz'.format(sub, ses, space_name))
+
+    else: # if session was 'no'
+        # define path to preprocessed functional and mask data (subject derivatives func folder)
+        prefix = 'sub-{}_task-{}'.format(sub, task)
+        funcDir = op.join(derivDir, 'sub-{}'.format(sub), 'func')
+        mni_mask = op.join(funcDir, 'sub-{}_space-{}_desc-brain_mask_allruns-BOLDmask.nii.gz'.format(sub, space_name))
+
+    # add run info to file prefix if necessary
+    if run_id != 0:
+        prefix = '{}_run-{:02d}'.format(prefix, run_id)
+
+    # identify mni file based on whether data are multiecho
+    if multiecho == 'yes': # if multiecho sequence, look for outputs in tedana folder
+        if run_id != 0:
+            tedana_folder = 'tedana/{}_run-{:02d}'.format(task, run_id)
+        else:
+            tedana_folder = 'tedana/{}'.format(task)
+
+        mni_file = glob.glob(op.join(funcDir, '{}'.format(tedana_folder), '{}_space-{}*desc-denoised_bold.nii.gz'.format(prefix, space_name)))[0]
+        mni_mask = glob.glob(op.join(funcDir, '{}'.format(tedana_folder), '{}_space-{}*desc-gmwmbold_mask.nii.gz'.format(prefix, space_name)))[0]
+        print('Will use multiecho outputs from tedana: {}'.format(mni_file))
+    else:            
+        mni_file = glob.glob(op.join(funcDir, '{}_space-{}*desc-preproc_bold.nii.gz'.format(prefix, space_name)))[0]
+
+    # grab the confound, MNI, and rapidart outlier file
+    confound_file = op.join(funcDir, '{}_desc-confounds_timeseries.tsv'.format(prefix))
+
+    if run_id != 0: # if run info is in filename
+        art_file = op.join(funcDir, 'art', '{}{:02d}'.format(task, run_id), 'art.{}_space-MNI152NLin2009cAsym_res-2_desc-preproc_bold_outliers.txt'.format(prefix))
+    else: # if no run info is in file name
+        art_file = op.join(funcDir, 'art', '{}'.format(task), 'art.{}_space-MNI152NLin2009cAsym_res-2_desc-preproc_bold_outliers.txt'.format(prefix))        
+
+    # get number of volumes in full functional run minus dropped volumes (done here in case splithalf files are requested)
+    nVols = (load(mni_file).shape[3] - dropvols)
+
+    # define run name depending on whether run info is in file name
+    if run_id != 0:
+        run_name = 'run{}'.format(run_id)
+    else:
+        run_name = 'run1' # if no run info is in filename, then results are saved under 'run1'
+
+    # check to see whether outputs exist in smoothDir (if smoothDir was specified in config file)
+    if smoothDir: 
+        if splithalf_id != 0:
+            smooth_file = glob.glob(op.join(smoothDir, 'sub-{}'.format(sub), 'preproc', '{}_splithalf{}'.format(run_name, splithalf_id), '{}_space-{}*preproc_bold_smooth.nii.gz'.format(prefix, space_name)))[0]
+        else:
+            smooth_file = glob.glob(op.join(smoothDir, 'sub-{}'.format(sub), 'preproc', '{}'.format(run_name), '{}_space-{}*preproc_bold_smooth.nii.gz'.format(prefix, space_name)))[0]
+
+        if os.path.exists(smooth_file):
+            mni_file = smooth_file
+            print('Previously smoothed data file has been found and will be used: {}'.format(mni_file))
+        else:
+            print('WARNING: A smoothDir was specified in the config file but no smoothed data files were found.')
+    else:
+        print('No smoothDir specified in the config file. Using fMRIPrep outputs.')
+
+    # define froi prefix if resultsDir was provided
+    if resultsDir:
+        if splithalf_id != 0:                    
+                # ensure that the fROI from the *opposite* splithalf is picked up for timecourse extraction (e.g., timecourse from splithalf1 is extracted from fROI defined in splithalf2)
+                if splithalf_id == 1:
+                    print('Will skip signal extraction in splithalf{} for any fROIs defined in splithalf{}'.format(splithalf_id, splithalf_id))
+                    froi_prefix = op.join(resultsDir, 'sub-{}'.format(sub), 'frois', '{}_splithalf2'.format(run_name))
+
+                if splithalf_id == 2:
+                    print('Will skip signal extraction in splithalf{} for any fROIs defined in splithalf{}'.format(splithalf_id, splithalf_id))
+                    froi_prefix = op.join(resultsDir, 'sub-{}'.format(sub), 'frois', '{}_splithalf1'.format(run_name))
+        else:
+            froi_prefix = op.join(resultsDir, 'sub-{}'.format(sub), 'frois', '{}'.format(run_name))
+
+    # define preproc directory depending on whether splithalf was requested
+    if splithalf_id != 0:
+        preprocDir = op.join(subDir, 'preproc', '{}_splithalf{}'.format(run_name, splithalf_id))
+    else:
+        preprocDir = op.join(subDir, 'preproc', '{}'.format(run_name))
+
+    # make preproc directory and save mni_file
+    os.makedirs(preprocDir, exist_ok=True)
+
+    # useful for checking data but no need to duplicate
+    #if not resultsDir:
+        #shutil.copy(mni_file, preprocDir)
+
+    # grab roi file for each mask requested
+    roi_masks = list()
+    for m in mask_opts:
+        if 'whole_brain' in m:
+            roi_masks.append(mni_mask)
+            print('Will extract whole brain timecourses')
+
+        # if a functional ROI was specified
+        elif 'fROI' in m:
+            if not froi_prefix: # resultsDir:
+                print('ERROR: unable to locate fROI file. Make sure a resultsDir is provided in the config file!')
+            else:
+                roi_name = m.split('fROI-')[1].split('_')[0]
+                # roi_name = roi_name.lower() # if roi names are lowercase in define_fROI.py script
+                roi_file = glob.glob(op.join('{}'.format(froi_prefix),'*{}*.nii.gz'.format(roi_name)))#[0]
+                roi_masks.append(roi_file)
+                print('Using {} fROI file from {}'.format(roi_name, roi_file))
+
+        # if a freesurfer ROI was specified
+        elif 'FS' in m:
+            roi_name = m.split('FS-')[1]
+            roi_file = glob.glob(op.join(projDir, 'files', 'ROIs' , '{}'.format(roi_name), '{}_*_{}.nii.gz'.format(sub, roi_name)))#[0]
+            roi_masks.append(roi_file)
+            print('Using {} FreeSurfer defined file from {}'.format(roi_name, roi_file))            
+
+        # if group ROI was specified
+        elif 'group' in m:
+            roi_name = m.split('group-')[1]
+            roi_file = glob.glob(op.join(projDir, 'files', 'ROIs' , '{}*.nii.gz'.format(roi_name)))[0]
+            roi_masks.append(roi_file)
+            print('Using {} group defined file from {}'.format(roi_name, roi_file))  
+
+        # if any other ROI was specified
+        else:
+            if template is not None:
+                #template_name = template[:6] # take first 6 characters
+                template_name = template.split('_')[0] # take full template name
+                roi_file = glob.glob(op.join(sharedDir, 'ROIs', '{}'.format(template_name), '{}*.nii.gz'.format(m)))[0]
+            else:
+                roi_file = glob.glob(op.join(sharedDir, 'ROIs', '{}*.nii.gz'.format(m)))[0]
+
+            roi_masks.append(roi_file)
+            print('Using {} ROI file from {}'.format(m, roi_file)) 
+
+    return confound_file, art_file, mni_file, mni_mask, roi_masks, nVols
+
+# define function to process data into halves for analysis (if requested in config file)
+def process_data_files(sub, mni_file, art_file, confound_file, regressor_opts, task, run_id, splithalf_id, TR, nVols, dropvols, subDir):
+    import os
+    import os.path as op
+    import pandas as pd
+    from pandas.errors import EmptyDataError
+    import numpy as np
+    from nibabel import load
+
+    # read in confound file (with pyarrow's multithreaded csv reader if available) to get cosine columns
+    try:
+        from pyarrow import csv as pacsv
+        confounds = pacsv.read_csv(confound_file, parse_options=pacsv.ParseOptions(delimiter='\t'), convert_options=pacsv.ConvertOptions(null_values=['n/a'])).to_pandas()
+    except ImportError:
+        confounds = pd.read_csv(confound_file, sep='\t', na_values='n/a')
+    cosine_columns = confounds.filter(regex='^cosine').columns.tolist()
+
+    # create a dictionary for mapping between config file and labels used in confounds file (more options can be added later)
+    regressor_dict = {'fd': 'framewise_displacement',
+                      'dvars': 'std_dvars',
+                      'acompcor': ['a_comp_cor_00', 'a_comp_cor_01', 'a_comp_cor_02', 'a_comp_cor_03', 'a_comp_cor_04'],
+                      'cosine': cosine_columns,
+                      'motion_params-6': ['trans_x', 'trans_y', 'trans_z', 'rot_x', 'rot_y', 'rot_z'],
+                      'motion_params-12': ['trans_x', 'trans_x_derivative1', 'trans_y', 'trans_y_derivative1', 'trans_z', 'trans_z_derivative1', 'rot_x', 'rot_x_derivative1', 'rot_y', 'rot_y_derivative1', 'rot_z', 'rot_z_derivative1']}
+
+    # extract the entries from the dictionary that match the key value provided in the config file
+    regressor_list=list({r: regressor_dict[r] for r in regressor_opts if r in regressor_dict}.values())
+
+    # remove nested lists if present (e.g., aCompCor regressors)
+    regressor_names=[]
+    for element in regressor_list:
+        if type(element) is list:
+            for item in element:
+                regressor_names.append(item)
+        else:
+            regressor_names.append(element)      
+
+    # read in art file, creating an empty dataframe if no outlier volumes (i.e., empty text file)
+    try:
+        outliers = pd.read_csv(art_file, header=None)[0].astype(int)
+    except EmptyDataError:
+        outliers = pd.DataFrame()      
+
+    # make art directory and specify splithalf outlier file name
+    if run_id != 0:
+        run_abrv = 'run{}'.format(run_id)
+        run_full = 'run-{:02d}'.format(run_id)
+        outlier_file_prefix = 'sub-{}_task-{}_{}'.format(sub, task, run_full)
+    else:
+        run_abrv = 'run1'
+        run_full = 'run-01'
+        outlier_file_prefix = 'sub-{}_task-{}'.format(sub, task)         
+
+    if splithalf_id == 0:  # if processing full run (splithalf = 'no' in config file)
+        artDir = op.join(subDir, 'art_files', '{}'.format(run_abrv))
+        outlier_file = op.join(artDir, '{}_out-vols.txt'.format(outlier_file_prefix))
+        vol_indx_file = op.join(artDir, '{}_incl-vols.txt'.format(outlier_file_prefix))
+    else:
+        artDir = op.join(subDir, 'art_files', '{}_splithalf{}'.format(run_abrv, splithalf_id))
+        outlier_file = op.join(artDir,'{}_splithalf-{:02d}_out-vols.txt'.format(outlier_file_prefix, splithalf_id))
+        vol_indx_file = op.join(artDir, '{}_splithalf-{:02d}_incl-vols.txt'.format(outlier_file_prefix, splithalf_id))
+
+    os.makedirs(artDir, exist_ok=True)
+
+    # select all regressors in one step, dropping volumes if requested
+    # framewise_displacement, dvars, and motion derivatives are relative to prior volume, so first value is nan (set to 0)
+    motion_params = confounds.iloc[dropvols:][regressor_names].fillna(0.0).astype(np.float32, copy=False)
+
+    print('Using the following nuisance regressors in the model: {}'.format(regressor_names))
+
+    # generate vector of volume indices (where inclusion means to retain volume) to use for scrubbing
+    vol_indx = np.arange(motion_params.shape[0], dtype=np.int64)
+
+    # if art regressor was included in regressor_opts list in config file        
+    if 'art' in regressor_opts:
+        print('ART identified motion spikes will be scrubbed from data')
+        if np.shape(outliers)[0] != 0: # if there are outlier volumes
+            # remove excluded volumes from vec
+            vol_indx = np.delete(vol_indx, [outliers])
+            print('{} outlier volumes will be scrubbed in {}'.format(len(outliers), run_full))
+
+    # get middle volume to define halves
+    midVol = int(nVols/2)
+    # number of volumes to drop per run (drop 6s total: 3s from each run)
+    drop_nVols = int((6/TR)/2)
+
+    # list of volumes to drop around midpoint (6s total, 3s on each side of midVol)
+    droppedVols = np.arange(midVol-drop_nVols, midVol+drop_nVols, 1)
+
+    # process full run if splithalf not requested
+    if splithalf_id == 0:
+        print('Using the full run for analysis')
+        t_min=0
+        t_size=nVols
+
+    # process first half of data
+    if splithalf_id == 1:
+        print('Splitting first half of the run for analysis')
+        # take first volume to middle volume, dropping final 3s of run
+        t_min=0
+        t_size=midVol-drop_nVols
+
+        motion_params = motion_params.head(midVol-drop_nVols) # select confound variables from first half
+        outliers = outliers[outliers < min(droppedVols)] # select outliers from first half
+        vol_indx = vol_indx[vol_indx < min(droppedVols)] # select included volumes from first half
+
+    # process second half of data
+    if splithalf_id == 2:
+        print('Splitting second half of the run for analysis')
+        # take middle volume to last volume, dropping first 3s of run
+        t_min=midVol+drop_nVols
+        t_size=midVol-drop_nVols
+
+        motion_params = motion_params.tail(midVol-drop_nVols) # select confound variables from second half
+        outliers = outliers[outliers > max(droppedVols)] # select outliers from second half
+        outliers = outliers-max(droppedVols+1) # outlier volume ids relative to start of run
+        vol_indx = vol_indx[vol_indx > max(droppedVols)] # select included volumes from second half
+        vol_indx = vol_indx-max(droppedVols+1) # volume ids relative to start of run
+
+    # get number of volumes in current run
+    curVols = load(mni_file).shape[3]
+
+    # process full timeseries if the current run is already split data
+    if curVols < nVols:
+        print('The data provided were already split into halves and will not be split again.')
+        t_min=0
+        t_size=curVols
+
+    # save outliers (split or not) as text file in subDir for modeling
+    outliers.to_csv(outlier_file, index=False, header=False)
+    pd.DataFrame(vol_indx).to_csv(vol_indx_file, index=False, header=False)
+
+    # return processed data - either split or full run depending on 'splithalf' parameter in config file
+    return t_min, t_size, motion_params, vol_indx, outliers
+
+# define function to smooth data with SUSAN or an isotropic Gaussian kernel (if requested in config file)
+def smooth_data(in_file, mni_file, mask_file, fwhm, smooth_backend, dropvols, t_min, t_size, cacheDir):
+    import os
+    import os.path as op
+    import shutil
+    import hashlib
+    import numpy as np
+    import nibabel as nib
+
+    # output file name matches the name produced by create_susan_smooth (so smoothDir outputs can be found later)
+    smoothed_file = op.abspath(op.basename(in_file).replace('.nii.gz', '_smooth.nii.gz'))
+
+    # smoothing is expensive, so reuse previously smoothed data if the inputs haven't changed
+    # the key uses the original fMRIPrep file (the split file is regenerated in the working directory on each launch) and the volumes selected from it
+    mni_stat = os.stat(mni_file)
+    mask_stat = os.stat(mask_file)
+    key = hashlib.sha1('{}:{}:{}:{}:{}:{}:{}:{}:{}:{}:{}'.format(mni_file, mni_stat.st_size, mni_stat.st_mtime, mask_file, mask_stat.st_size, mask_stat.st_mtime,
+                                                               dropvols, t_min, t_size, fwhm, smooth_backend).encode()).hexdigest()
+    cache_file = op.join(cacheDir, '{}.nii.gz'.format(key))
+
+    # cached files are hard linked where possible, so the cache doesn't hold another full copy of each run (the smooth_cache directory can be deleted at any time to free space)
+    def link_or_copy(src, dst):
+        try:
+            os.link(src, dst)
+        except OSError:
+            shutil.copy(src, dst)
+
+    if op.exists(cache_file):
+        print('Previously smoothed data with identical inputs found and will be used: {}'.format(cache_file))
+        link_or_copy(cache_file, smoothed_file)
+        return smoothed_file
+
+    if smooth_backend in ['gaussian', 'gpu']:
+        # use the GPU if requested and CuPy is available, otherwise fall back to scipy on the CPU
+        xp = np
+        if smooth_backend == 'gpu':
+            try:
+                import cupy as xp
+                from cupyx.scipy.ndimage import gaussian_filter
+            except ImportError:
+                print('WARNING: CuPy is not available. Gaussian smoothing will be run on the CPU.')
+                xp = np
+        if xp is np:
+            from scipy.ndimage import gaussian_filter
+
+        # load functional data and mask
+        img = nib.load(in_file)
+        data = np.asarray(img.dataobj, dtype=np.float32)
+        mask = xp.asarray(np.asarray(nib.load(mask_file).dataobj) > 0)
+
+        # convert fwhm (mm) to sigma (voxels) for each spatial axis
+        sigma = [fwhm / np.sqrt(8 * np.log(2)) / v for v in img.header.get_zooms()[:3]]
+
+        # smooth each volume with a separable 3D Gaussian, restricting output to the brain mask
+        smoothed = np.empty_like(data)
+        for vol in range(data.shape[3]):
+            vol_data = gaussian_filter(xp.asarray(data[..., vol]), sigma=sigma)
+            vol_data[~mask] = 0
+            smoothed[..., vol] = vol_data.get() if xp is not np else vol_data
+
+        # save smoothed data
+        smooth_img = nib.Nifti1Image(smoothed, img.affine, img.header)
+        smooth_img.set_data_dtype(np.float32)
+        nib.save(smooth_img, smoothed_file)
+    else:
+        # FSL's SUSAN algorithm, following the steps of create_susan_smooth
+        # the mask is used for estimating SUSAN thresholds (but not for smoothing)
+        from nipype.interfaces import fsl
+        median = fsl.ImageStats(in_file=in_file, mask_file=mask_file, op_string='-k %s -p 50').run().outputs.out_stat
+        masked = fsl.ImageMaths(in_file=in_file, in_file2=mask_file, op_string='-mas', suffix='_mask').run().outputs.out_file
+        meanfunc = fsl.ImageMaths(in_file=masked, op_string='-Tmean', suffix='_mean').run().outputs.out_file
+        fsl.SUSAN(in_file=in_file, fwhm=fwhm, brightness_threshold=0.75 * median, usans=[(meanfunc, 0.75 * median)], out_file=smoothed_file).run()
+
+    # add to the smoothing cache under a temporary name first and rename it into place, so an interrupted copy (or another job writing the same key) never leaves a partial cache file
+    os.makedirs(cacheDir, exist_ok=True)
+    tmp_file = op.join(cacheDir, '{}.{}.tmp.nii.gz'.format(key, os.getpid()))
+    link_or_copy(smoothed_file, tmp_file)
+    os.replace(tmp_file, cache_file)
+
+    return smoothed_file
+
+# define function to denoise data
+def denoise_data(imgs, mni_mask, mask_file, motion_params, vol_indx, outliers, TR, hpf, filter_opt, filter_sos, detrend, standardize, output_dtype, subDir, sub, run_id, splithalf_id, task):
+    import nibabel as nib
+    import pandas as pd
+    import numpy as np
+    import os
+    import os.path as op
+    import shutil
+    import subprocess
+
+    # define function to save gzipped nifti files, compressing with pigz if it is installed (nibabel compresses on a single core)
+    # pigz uses 2 threads because several runs are denoised at once by MultiProc
+    # files are written under a temporary name and renamed when complete, so an interrupted save never leaves a partial output file
+    def save_nifti(img, out_file):
+        tmp_file = out_file.replace('.nii.gz', '.tmp.nii.gz')
+        if shutil.which('pigz'):
+            nib.save(img, tmp_file.replace('.nii.gz', '.nii'))
+            subprocess.run(['pigz', '-f', '-p', '2', tmp_file.replace('.nii.gz', '.nii')], check=True)
+        else:
+            nib.save(img, tmp_file)
+        os.replace(tmp_file, out_file)
+
+    # define run name depending on whether run info is in file name
+    if run_id != 0:
+        run_abrv = 'run{}'.format(run_id)
+        run_full = 'run-{:02d}'.format(run_id)
+    else: # if no run info is in filename, then results are saved under 'run1'
+        run_abrv = 'run1'
+        run_full = 'run-01'
+
+    # make output directory
+    if splithalf_id != 0:
+        denoiseDir = op.join(subDir, 'denoised', '{}_splithalf{}'.format(run_abrv, splithalf_id))
+        split_name = '_splithalf-{:02d}_'.format(splithalf_id)
+    else:
+        denoiseDir = op.join(subDir, 'denoised', '{}'.format(run_abrv))
+        split_name = '_'
+
+    os.makedirs(denoiseDir, exist_ok=True)
+
+    # define output file names depending on whether run info is in file name
+    if run_id != 0:
+        denoise_file = op.join(denoiseDir, 'sub-{}_task-{}_{}{}denoised_bold.nii.gz'.format(sub, task, run_full, split_name))
+        pad_file = op.join(denoiseDir, 'sub-{}_task-{}_{}{}denoised_padded_bold.nii.gz'.format(sub, task, run_full, split_name))
+
+    else: # if no run info is in filename, then results are saved under 'run1'
+        denoise_file = op.join(denoiseDir, 'sub-{}_task-{}{}denoised_bold.nii.gz'.format(sub, task, split_name))
+        pad_file = op.join(denoiseDir, 'sub-{}_task-{}{}denoised_padded_bold.nii.gz'.format(sub, task, split_name))
+
+    # a path to the file is needed (take the first file if a list is passed)
+    if isinstance(imgs, list):
+        imgs=imgs[0]        
+
+    # process options from config file
+    if detrend == 'yes':
+        detrend_opt = True
+    else:
+        detrend_opt = False
+    if standardize != 'no':
+        standardize_opt = standardize
+    else:
+        standardize_opt = False
+
+    # convert filter from seconds to Hz
+    hpf_hz = 1/hpf
+
+    print('Will apply a {} filter using a high pass filter cutoff of {}Hz for {}.'.format(filter_opt, hpf_hz, run_full))
+
+    # load functional data once as float32 and apply the brain mask to get a (timepoints x voxels) matrix
+    # this follows the steps of nilearn's signal.clean but streams the data in float32 instead of float64
+    # note: the high pass filter requested in the config file is applied here; the earlier image.clean_img call never received the cutoff, so no filtering was done before
+    func_img = nib.load(imgs)
+    func_data = np.asarray(func_img.dataobj, dtype=np.float32)
+    if mask_file: # boolean mask array saved once for all runs of the subject
+        mask = np.load(mask_file, mmap_mode='r')
+    else:
+        mask = np.asarray(nib.load(mni_mask).dataobj).astype(bool)
+    Y = np.ascontiguousarray(func_data[mask].T)
+    curVols = Y.shape[0]
+    del func_data
+
+    # confounds and boolean vector of retained volumes
+    X = np.asarray(motion_params, dtype=np.float64)
+    if X.ndim == 1:
+        X = X[:, None]
+    sample_mask = np.zeros(curVols, dtype=bool)
+    sample_mask[vol_indx] = True
+    frame_times = np.arange(curVols) * TR
+
+    # add discrete cosine drift terms to the confounds for the cosine filter (constant term excluded)
+    if filter_opt == 'cosine':
+        order = min(curVols - 1, int(np.floor(2 * curVols * hpf_hz * TR)))
+        cosine_drift = np.sqrt(2.0 / curVols) * np.cos((np.pi / curVols) * (np.arange(curVols)[:, None] + .5) * np.arange(1, order + 1))
+        X = np.hstack([X, cosine_drift])
+
+    # scrubbed volumes are interpolated before butterworth filtering (and removed afterwards), otherwise removed now
+    # scrubbed volumes at the start or end of the run are extrapolated, as in nilearn's signal.clean (extrapolate=True by default since nilearn 0.9)
+    if filter_opt == 'butterworth' and not sample_mask.all():
+        from scipy.interpolate import CubicSpline
+        Y[~sample_mask] = CubicSpline(frame_times[sample_mask], Y[sample_mask], axis=0, extrapolate=True)(frame_times[~sample_mask])
+        X[~sample_mask] = CubicSpline(frame_times[sample_mask], X[sample_mask], axis=0, extrapolate=True)(frame_times[~sample_mask])
+    elif not sample_mask.all():
+        Y = Y[sample_mask]
+        X = X[sample_mask]
+
+    # remove mean and linear trend from signals and confounds
+    if detrend_opt:
+        mean_signals = Y.mean(axis=0)
+        trend = np.arange(Y.shape[0], dtype=np.float64)
+        trend -= trend.mean()
+        trend /= np.sqrt((trend ** 2).sum())
+        X -= X.mean(axis=0)
+        X -= np.outer(trend, trend @ X)
+        trend = trend.astype(np.float32)
+        Y -= mean_signals
+        Y -= np.outer(trend, trend @ Y)
+
+    # butterworth high pass filter applied to signals and confounds (5th order, zero phase), then scrubbed volumes removed
+    if filter_opt == 'butterworth':
+        from scipy.signal import sosfiltfilt
+        sos = np.asarray(filter_sos)
+        Y = sosfiltfilt(sos, Y, axis=0).astype(np.float32)
+        X = sosfiltfilt(sos, X, axis=0)
+        Y = Y[sample_mask]
+        X = X[sample_mask]
+
+    # regress standardized confounds out of the signals (pivoted QR drops rank deficient confounds)
+    if X.shape[1] > 0:
+        from scipy.linalg import qr
+        X_std = X.std(axis=0)
+        X_std[X_std < np.finfo(np.float64).eps] = 1.
+        X = (X - X.mean(axis=0)) / X_std
+        Q, R, _ = qr(X, mode='economic', pivoting=True)
+        Q = Q[:, np.abs(np.diag(R)) > np.finfo(np.float64).eps * 100.].astype(np.float32)
+        # project out confounds in blocks of voxels so the intermediate arrays stay in cache (avoids a full timepoints x voxels temporary)
+        for v in range(0, Y.shape[1], 4096):
+            Y[:, v:v+4096] -= Q @ (Q.T @ Y[:, v:v+4096])
+
+    # standardize signals if requested
+    if standardize_opt == 'psc':
+        if detrend_opt: # the original mean signal is needed to calculate percent signal change
+            Y += mean_signals
+        mean_signals = Y.mean(axis=0)
+        invalid_ix = np.abs(mean_signals) < np.finfo(np.float64).eps
+        Y = (Y - mean_signals) / np.abs(mean_signals) * 100
+        Y[:, invalid_ix] = 0
+    elif standardize_opt in ['zscore', 'zscore_sample']:
+        Y -= Y.mean(axis=0)
+        Y_std = Y.std(axis=0, ddof=1 if standardize_opt == 'zscore_sample' else 0)
+        Y_std[Y_std < np.finfo(np.float64).eps] = 1.
+        Y /= Y_std
+    elif standardize_opt:
+        raise ValueError('{} is not a valid standardize option. Use zscore, zscore_sample, psc, or no in the config file.'.format(standardize_opt))
+
+    # return cleaned signals to image space (voxels outside the mask are 0)
+    denoised_arr = np.zeros(mask.shape + (Y.shape[0],), dtype=np.float32)
+    denoised_arr[mask] = Y.T
+    denoised_data = nib.Nifti1Image(denoised_arr, func_img.affine, func_img.header)
+    if output_dtype == 'int16':
+        # nibabel sets scl_slope/scl_inter on save to fit the data to the int16 range (halves file size)
+        denoised_data.set_data_dtype(np.int16)
+    else:
+        denoised_data.set_data_dtype(np.float32)
+
+    # save denoised data
+    save_nifti(denoised_data, denoise_file)
+
+    # pad denoised data with nan vols where vols were scrubbed
+    # the denoised data has a volume for each index in vol_indx [curVols - outliers], so fill those in one step and write nan only to the scrubbed volumes
+    pad = np.empty(mask.shape + (curVols,), dtype=np.float32)
+    pad[..., vol_indx] = denoised_arr
+    pad[..., ~sample_mask] = np.nan
+    pad_concat = nib.Nifti1Image(pad, func_img.affine, func_img.header)
+    pad_concat.set_data_dtype(np.float32)
+
+    # save padded data
+    save_nifti(pad_concat, pad_file)
+
+    # return file paths rather than images so nipype doesn't pickle the full 4D arrays into the node results
+    return denoise_file, pad_file
+
+# define function to extract timecourses from denoised data for each ROI
+def extract_timecourse(denoise_file, pad_file, roi_masks, mask_opts, extract_opt, outDir, subDir, sub, run_id, splithalf_id, task, nVols, vol_indx):
+    import nibabel as nib
+    from nilearn.maskers import NiftiMasker
+    from nilearn import image
+    import re
+    import os
+    import os.path as op
+    import numpy as np
+    import pandas as pd 
+
+    # make output directory
+    tcDir = op.join(subDir, 'timecourses')
+    os.makedirs(tcDir, exist_ok=True)
+
+    # define run name depending on whether run info is in file name
+    if run_id != 0:
+        run_full = 'run-{:02d}'.format(run_id)
+    else: # if no run info is in filename, then results are saved under 'run1'
+        run_full = 'run-01'
+
+    run_prefix = op.join(tcDir, 'sub-{}_task-{}_{}'.format(sub, task, run_full))
+
+    # read image dimensions of denoised data from the file header (data array isn't loaded)
+    denoised_data = nib.load(denoise_file)
+    
+    # load padded data once for all ROIs
+    pad_img = nib.load(pad_file)
+    pad_concat = nib.Nifti1Image(np.asarray(pad_img.dataobj, dtype=np.float32), pad_img.affine, pad_img.header)
+
+    # extract timecourses for each ROI provided in config file
+    for m, mask in enumerate(roi_masks):
+
+        print('Extracting signal from {} ROI'.format(mask_opts[m]))
+
+        # ensure that mask/ROI is binarized
+        mask_img = image.load_img(mask)
+        mask_bin = mask_img.get_fdata() # get image data (as floating point data)
+        mask_bin[mask_bin >= 1] = 1 # for values equal to or greater than 1, make 1 (values less than 1 are already 0)
+        mask_bin = image.new_img_like(mask_img, mask_bin) # create a new image of the same class as the initial image
+
+        # the masks should already be resampled, but check if this is true and resample if not
+        if denoised_data.shape[0:3] != mask_bin.shape[0:3]:
+            print('WARNING: the mask provided has different dimensions than the functional data!')
+
+            # make directory to save resampled rois
+            roiDir = op.join(outDir, 'resampled_rois')
+            os.makedirs(roiDir, exist_ok=True)
+
+            # extract file name
+            roi_name = mask[0].split('/')[-1].split('.nii.gz')[0]
+
+            resampled_file = op.join(roiDir, '{}_resampled.nii.gz'.format(roi_name))
+
+            # check if file already exists
+            if os.path.isfile(resampled_file):
+                print('Found previously resampled {} ROI in output directory'.format(mask_opts[m]))
+                mask_bin = image.load_img(resampled_file)
+            else:
+                # resample image
+                print('Resampling {} ROI to match functional data'.format(mask_opts[m]))
+                mask_bin = image.resample_to_img(mask_bin, denoised_data, interpolation='nearest')
+                mask_bin.to_filename(resampled_file)
+
+        # instantiate the masker
+        masker = NiftiMasker(mask_img = mask_bin)
+
+        # apply mask to denoised padded data
+        padded_masked = masker.fit_transform(pad_concat)
+        padded_masked_df = pd.DataFrame(padded_masked)
+
+        # add splithalf info to output file name     
+        if splithalf_id != 0:
+            if 'fROI' in mask_opts[m]:
+                # extract fROI name
+                froi = mask_opts[m].split('_')[0]
+
+                # extract contrast used to generate fROI from file name
+                contrast = roi_masks[m][0].split('_')[-2]
+
+                # get fROI splithalf info from roi mask and add to output file name
+                roi_splithalf = re.search('splithalf-(.+?)_', roi_masks[m][0]).group().split('_')[0]
+
+                tc_prefix = op.join('{}_splithalf-{:02d}_{}-{}-{}'.format(run_prefix, splithalf_id, froi, contrast, roi_splithalf))
+            else:
+                tc_prefix = op.join('{}_splithalf-{:02d}_{}'.format(run_prefix, splithalf_id, mask_opts[m]))
+        else:
+            tc_prefix = op.join('{}_{}'.format(run_prefix, mask_opts[m]))
+
+        # average data in mask if requested and add info to output file name
+        if extract_opt == 'mean':
+            # average voxelwise timecourses
+            print('Averging voxelwise timecourses within {} mask'.format(mask_opts[m]))
+            padded_masked_df = padded_masked_df.mean(axis=1).replace([0], np.nan)
+            tc_file = op.join('{}_mean_timecourse.csv'.format(tc_prefix))
+        else:
+            tc_file = op.join('{}_voxelwise_timecourses.csv'.format(tc_prefix))
+
+        # save file
+        padded_masked_df.to_csv(tc_file, header = False, index=False)
+
+    return padded_masked
 
 # define first level workflow function
 def create_timecourse_workflow(sharedDir, projDir, derivDir, workDir, outDir, subDir, 
-                               sub, task, ses, multiecho, runs, regressor_opts, mask_opts, smoothing_kernel_size, resultsDir, smoothDir, hpf, filter_opt, TR, detrend,standardize, template, extract_opt, dropvols, splithalves, space_name,
+                               sub, task, ses, multiecho, runs, regressor_opts, mask_opts, smoothing_kernel_size, resultsDir, smoothDir, hpf, filter_opt, TR, detrend,standardize, template, extract_opt, dropvols, splithalves, space_name, smooth_backend, output_dtype, mask_file, cacheDir,
                                name='sub-{}_task-{}_timecourses'):
     """Processing pipeline"""
 
@@ -46,159 +700,21 @@ def create_timecourse_workflow(sharedDir, projDir, derivDir, workDir, outDir, su
     infosource.synchronize = True
    
     # enable/disable smoothing based on value provided in config file
-    if smoothing_kernel_size != 0: # if smoothing kernel size is not 0
+    if smoothing_kernel_size != 0 and smoothDir: # if previously smoothed data will be used
+        # don't smooth the data a second time
+        run_smoothing = False
+        print('A smoothDir was specified in the config file. Previously smoothed data will be used and spatial smoothing will not be run again.')
+    elif smoothing_kernel_size != 0: # if smoothing kernel size is not 0
         # use spatial smoothing
         run_smoothing = True
         print('Spatial smoothing will be run using a {}mm smoothing kernel.'.format(smoothing_kernel_size))
+        if smooth_backend in ['gaussian', 'gpu']:
+            print('Smoothing will use an isotropic Gaussian kernel ({} backend) instead of SUSAN.'.format(smooth_backend))
     else: 
         # don't do spatial smoothing
         run_smoothing = False
         print('Spatial smoothing will not be run.')
         
-    # define data grabber function
-    def data_grabber(sub, task, mask_opts, sharedDir, projDir, derivDir, resultsDir, smoothDir, subDir, template, dropvols, ses, multiecho, run_id, splithalf_id, space_name):
-        """Quick filegrabber ala SelectFiles/DataGrabber"""
-        import os
-        import os.path as op
-        import glob
-        import shutil
-        from nibabel import load
-
-        # define output filename and path, depending on whether session information is in directory/file names
-        if ses != 'no': # if session was provided
-            # define path to preprocessed functional and mask data (subject derivatives func folder)
-            prefix = 'sub-{}_ses-{}_task-{}'.format(sub, ses, task)
-            funcDir = op.join(derivDir, 'sub-{}'.format(sub), 'ses-{}'.format(ses), 'func')
-            mni_mask = op.join(funcDir, 'sub-{}_ses-{}_space-{}_desc-brain_mask_allruns-BOLDmask.nii.gz'.format(sub, ses, space_name))
-            
-        else: # if session was 'no'
-            # define path to preprocessed functional and mask data (subject derivatives func folder)
-            prefix = 'sub-{}_task-{}'.format(sub, task)
-            funcDir = op.join(derivDir, 'sub-{}'.format(sub), 'func')
-            mni_mask = op.join(funcDir, 'sub-{}_space-{}_desc-brain_mask_allruns-BOLDmask.nii.gz'.format(sub, space_name))
-        
-        # add run info to file prefix if necessary
-        if run_id != 0:
-            prefix = '{}_run-{:02d}'.format(prefix, run_id)
-        
-        # identify mni file based on whether data are multiecho
-        if multiecho == 'yes': # if multiecho sequence, look for outputs in tedana folder
-            if run_id != 0:
-                tedana_folder = 'tedana/{}_run-{:02d}'.format(task, run_id)
-            else:
-                tedana_folder = 'tedana/{}'.format(task)
-                
-            mni_file = glob.glob(op.join(funcDir, '{}'.format(tedana_folder), '{}_space-{}*desc-denoised_bold.nii.gz'.format(prefix, space_name)))[0]
-            mni_mask = glob.glob(op.join(funcDir, '{}'.format(tedana_folder), '{}_space-{}*desc-gmwmbold_mask.nii.gz'.format(prefix, space_name)))[0]
-            print('Will use multiecho outputs from tedana: {}'.format(mni_file))
-        else:            
-            mni_file = glob.glob(op.join(funcDir, '{}_space-{}*desc-preproc_bold.nii.gz'.format(prefix, space_name)))[0]
-        
-        # grab the confound, MNI, and rapidart outlier file
-        confound_file = op.join(funcDir, '{}_desc-confounds_timeseries.tsv'.format(prefix))
-        
-        if run_id != 0: # if run info is in filename
-            art_file = op.join(funcDir, 'art', '{}{:02d}'.format(task, run_id), 'art.{}_space-MNI152NLin2009cAsym_res-2_desc-preproc_bold_outliers.txt'.format(prefix))
-        else: # if no run info is in file name
-            art_file = op.join(funcDir, 'art', '{}'.format(task), 'art.{}_space-MNI152NLin2009cAsym_res-2_desc-preproc_bold_outliers.txt'.format(prefix))        
-
-        # get number of volumes in full functional run minus dropped volumes (done here in case splithalf files are requested)
-        nVols = (load(mni_file).shape[3] - dropvols)
-        
-        # define run name depending on whether run info is in file name
-        if run_id != 0:
-            run_name = 'run{}'.format(run_id)
-        else:
-            run_name = 'run1' # if no run info is in filename, then results are saved under 'run1'
-        
-        # check to see whether outputs exist in smoothDir (if smoothDir was specified in config file)
-        if smoothDir: 
-            if splithalf_id != 0:
-                smooth_file = glob.glob(op.join(smoothDir, 'sub-{}'.format(sub), 'preproc', '{}_splithalf{}'.format(run_name, splithalf_id), '{}_space-{}*preproc_bold_smooth.nii.gz'.format(prefix, space_name)))[0]
-            else:
-                smooth_file = glob.glob(op.join(smoothDir, 'sub-{}'.format(sub), 'preproc', '{}'.format(run_name), '{}_space-{}*preproc_bold_smooth.nii.gz'.format(prefix, space_name)))[0]
-
-            if os.path.exists(smooth_file):
-                mni_file = smooth_file
-                print('Previously smoothed data file has been found and will be used: {}'.format(mni_file))
-            else:
-                print('WARNING: A smoothDir was specified in the config file but no smoothed data files were found.')
-        else:
-            print('No smoothDir specified in the config file. Using fMRIPrep outputs.')
-        
-        # define froi prefix if resultsDir was provided
-        if resultsDir:
-            if splithalf_id != 0:                    
-                    # ensure that the fROI from the *opposite* splithalf is picked up for timecourse extraction (e.g., timecourse from splithalf1 is extracted from fROI defined in splithalf2)
-                    if splithalf_id == 1:
-                        print('Will skip signal extraction in splithalf{} for any fROIs defined in splithalf{}'.format(splithalf_id, splithalf_id))
-                        froi_prefix = op.join(resultsDir, 'sub-{}'.format(sub), 'frois', '{}_splithalf2'.format(run_name))
-                        
-                    if splithalf_id == 2:
-                        print('Will skip signal extraction in splithalf{} for any fROIs defined in splithalf{}'.format(splithalf_id, splithalf_id))
-                        froi_prefix = op.join(resultsDir, 'sub-{}'.format(sub), 'frois', '{}_splithalf1'.format(run_name))
-            else:
-                froi_prefix = op.join(resultsDir, 'sub-{}'.format(sub), 'frois', '{}'.format(run_name))
-        
-        # define preproc directory depending on whether splithalf was requested
-        if splithalf_id != 0:
-            preprocDir = op.join(subDir, 'preproc', '{}_splithalf{}'.format(run_name, splithalf_id))
-        else:
-            preprocDir = op.join(subDir, 'preproc', '{}'.format(run_name))
-        
-        # make preproc directory and save mni_file
-        os.makedirs(preprocDir, exist_ok=True)
-        
-        # useful for checking data but no need to duplicate
-        #if not resultsDir:
-            #shutil.copy(mni_file, preprocDir)
-        
-        # grab roi file for each mask requested
-        roi_masks = list()
-        for m in mask_opts:
-            if 'whole_brain' in m:
-                roi_masks.append(mni_mask)
-                print('Will extract whole brain timecourses')
-            
-            # if a functional ROI was specified
-            elif 'fROI' in m:
-                if not froi_prefix: # resultsDir:
-                    print('ERROR: unable to locate fROI file. Make sure a resultsDir is provided in the config file!')
-                else:
-                    roi_name = m.split('fROI-')[1].split('_')[0]
-                    # roi_name = roi_name.lower() # if roi names are lowercase in define_fROI.py script
-                    roi_file = glob.glob(op.join('{}'.format(froi_prefix),'*{}*.nii.gz'.format(roi_name)))#[0]
-                    roi_masks.append(roi_file)
-                    print('Using {} fROI file from {}'.format(roi_name, roi_file))
-            
-            # if a freesurfer ROI was specified
-            elif 'FS' in m:
-                roi_name = m.split('FS-')[1]
-                roi_file = glob.glob(op.join(projDir, 'files', 'ROIs' , '{}'.format(roi_name), '{}_*_{}.nii.gz'.format(sub, roi_name)))#[0]
-                roi_masks.append(roi_file)
-                print('Using {} FreeSurfer defined file from {}'.format(roi_name, roi_file))            
-            
-            # if group ROI was specified
-            elif 'group' in m:
-                roi_name = m.split('group-')[1]
-                roi_file = glob.glob(op.join(projDir, 'files', 'ROIs' , '{}*.nii.gz'.format(roi_name)))[0]
-                roi_masks.append(roi_file)
-                print('Using {} group defined file from {}'.format(roi_name, roi_file))  
-            
-            # if any other ROI was specified
-            else:
-                if template is not None:
-                    #template_name = template[:6] # take first 6 characters
-                    template_name = template.split('_')[0] # take full template name
-                    roi_file = glob.glob(op.join(sharedDir, 'ROIs', '{}'.format(template_name), '{}*.nii.gz'.format(m)))[0]
-                else:
-                    roi_file = glob.glob(op.join(sharedDir, 'ROIs', '{}*.nii.gz'.format(m)))[0]
-                
-                roi_masks.append(roi_file)
-                print('Using {} ROI file from {}'.format(m, roi_file)) 
-        
-        return confound_file, art_file, mni_file, mni_mask, roi_masks, nVols
-        
     datasource = Node(Function(output_names=['confound_file',
                                              'art_file',
                                              'mni_file',
@@ -230,150 +746,6 @@ def create_timecourse_workflow(sharedDir, projDir, derivDir, workDir, outDir, su
         roi = Node(fsl.ExtractROI(t_min=dropvols, t_size=-1), name='extractroi')
         wf.connect(datasource, 'mni_file', roi, 'in_file')
 
-    # define function to process data into halves for analysis (if requested in config file)
-    def process_data_files(sub, mni_file, art_file, confound_file, regressor_opts, task, run_id, splithalf_id, TR, nVols, dropvols, subDir):
-        import os
-        import os.path as op
-        import pandas as pd
-        from pandas.errors import EmptyDataError
-        import numpy as np
-        from nibabel import load
-        
-        # read in confound file to get cosine columns
-        confounds = pd.read_csv(confound_file, sep='\t', na_values='n/a')
-        cosine_columns = confounds.filter(regex='^cosine').columns.tolist()
-                
-        # create a dictionary for mapping between config file and labels used in confounds file (more options can be added later)
-        regressor_dict = {'fd': 'framewise_displacement',
-                          'dvars': 'std_dvars',
-                          'acompcor': ['a_comp_cor_00', 'a_comp_cor_01', 'a_comp_cor_02', 'a_comp_cor_03', 'a_comp_cor_04'],
-                          'cosine': cosine_columns,
-                          'motion_params-6': ['trans_x', 'trans_y', 'trans_z', 'rot_x', 'rot_y', 'rot_z'],
-                          'motion_params-12': ['trans_x', 'trans_x_derivative1', 'trans_y', 'trans_y_derivative1', 'trans_z', 'trans_z_derivative1', 'rot_x', 'rot_x_derivative1', 'rot_y', 'rot_y_derivative1', 'rot_z', 'rot_z_derivative1']}
-        
-        # extract the entries from the dictionary that match the key value provided in the config file
-        regressor_list=list({r: regressor_dict[r] for r in regressor_opts if r in regressor_dict}.values())
-        
-        # remove nested lists if present (e.g., aCompCor regressors)
-        regressor_names=[]
-        for element in regressor_list:
-            if type(element) is list:
-                for item in element:
-                    regressor_names.append(item)
-            else:
-                regressor_names.append(element)      
-        
-        # read in and filter confound file according to config file options
-        confounds = pd.read_csv(confound_file, sep='\t', na_values='n/a')
-        #confounds = confounds.filter(regressor_names)
-
-        # read in art file, creating an empty dataframe if no outlier volumes (i.e., empty text file)
-        try:
-            outliers = pd.read_csv(art_file, header=None)[0].astype(int)
-        except EmptyDataError:
-            outliers = pd.DataFrame()      
-        
-        # make art directory and specify splithalf outlier file name
-        if run_id != 0:
-            run_abrv = 'run{}'.format(run_id)
-            run_full = 'run-{:02d}'.format(run_id)
-            outlier_file_prefix = 'sub-{}_task-{}_{}'.format(sub, task, run_full)
-        else:
-            run_abrv = 'run1'
-            run_full = 'run-01'
-            outlier_file_prefix = 'sub-{}_task-{}'.format(sub, task)         
-        
-        if splithalf_id == 0:  # if processing full run (splithalf = 'no' in config file)
-            artDir = op.join(subDir, 'art_files', '{}'.format(run_abrv))
-            outlier_file = op.join(artDir, '{}_out-vols.txt'.format(outlier_file_prefix))
-            vol_indx_file = op.join(artDir, '{}_incl-vols.txt'.format(outlier_file_prefix))
-        else:
-            artDir = op.join(subDir, 'art_files', '{}_splithalf{}'.format(run_abrv, splithalf_id))
-            outlier_file = op.join(artDir,'{}_splithalf-{:02d}_out-vols.txt'.format(outlier_file_prefix, splithalf_id))
-            vol_indx_file = op.join(artDir, '{}_splithalf-{:02d}_incl-vols.txt'.format(outlier_file_prefix, splithalf_id))
-        
-        os.makedirs(artDir, exist_ok=True)
-
-        # for each regressor
-        regressors = []            
-        for regressor in regressor_names:
-            # framewise_displacement and dvars are relative to prior volume, so first value is nan
-            if regressor == 'framewise_displacement' or regressor == 'std_dvars' or '_x' in regressor or '_y' in regressor or '_z' in regressor:
-                print('Processing {} regressor'.format(regressor))
-                regressors.append(confounds[regressor].fillna(0).iloc[dropvols:])
-            else:
-                regressors.append(confounds[regressor].iloc[dropvols:])
-        
-        print('Using the following nuisance regressors in the model: {}'.format(regressor_names))        
- 
-        # convert motion regressors to dataframe
-        motion_params = pd.DataFrame(regressors).transpose()
-        
-        # generate vector of volume indices (where inclusion means to retain volume) to use for scrubbing
-        vol_indx = np.arange(motion_params.shape[0], dtype=np.int64)
-        
-        # if art regressor was included in regressor_opts list in config file        
-        if 'art' in regressor_opts:
-            print('ART identified motion spikes will be scrubbed from data')
-            if np.shape(outliers)[0] != 0: # if there are outlier volumes
-                # remove excluded volumes from vec
-                vol_indx = np.delete(vol_indx, [outliers])
-                print('{} outlier volumes will be scrubbed in {}'.format(len(outliers), run_full))
-        
-        # get middle volume to define halves
-        midVol = int(nVols/2)
-        # number of volumes to drop per run (drop 6s total: 3s from each run)
-        drop_nVols = int((6/TR)/2)
-        
-        # list of volumes to drop around midpoint (6s total, 3s on each side of midVol)
-        droppedVols = np.arange(midVol-drop_nVols, midVol+drop_nVols, 1)
-        
-        # process full run if splithalf not requested
-        if splithalf_id == 0:
-            print('Using the full run for analysis')
-            t_min=0
-            t_size=nVols
-        
-        # process first half of data
-        if splithalf_id == 1:
-            print('Splitting first half of the run for analysis')
-            # take first volume to middle volume, dropping final 3s of run
-            t_min=0
-            t_size=midVol-drop_nVols
-            
-            motion_params = motion_params.head(midVol-drop_nVols) # select confound variables from first half
-            outliers = outliers[outliers < min(droppedVols)] # select outliers from first half
-            vol_indx = vol_indx[vol_indx < min(droppedVols)] # select included volumes from first half
-            
-        # process second half of data
-        if splithalf_id == 2:
-            print('Splitting second half of the run for analysis')
-            # take middle volume to last volume, dropping first 3s of run
-            t_min=midVol+drop_nVols
-            t_size=midVol-drop_nVols
-            
-            motion_params = motion_params.tail(midVol-drop_nVols) # select confound variables from second half
-            outliers = outliers[outliers > max(droppedVols)] # select outliers from second half
-            outliers = outliers-max(droppedVols+1) # outlier volume ids relative to start of run
-            vol_indx = vol_indx[vol_indx > max(droppedVols)] # select included volumes from second half
-            vol_indx = vol_indx-max(droppedVols+1) # volume ids relative to start of run
-
-        # get number of volumes in current run
-        curVols = load(mni_file).shape[3]
- 
-        # process full timeseries if the current run is already split data
-        if curVols < nVols:
-            print('The data provided were already split into halves and will not be split again.')
-            t_min=0
-            t_size=curVols
-
-        # save outliers (split or not) as text file in subDir for modeling
-        outliers.to_csv(outlier_file, index=False, header=False)
-        pd.DataFrame(vol_indx).to_csv(vol_indx_file, index=False, header=False)
-        
-        # return processed data - either split or full run depending on 'splithalf' parameter in config file
-        return t_min, t_size, motion_params, vol_indx, outliers
-         
     # set up splitdata Node with specified outputs
     splitdata = Node(Function(output_names=['t_min',
                                             't_size',
@@ -410,136 +782,26 @@ def create_timecourse_workflow(sharedDir, projDir, derivDir, workDir, outDir, su
 
     # if requested, smooth before running model
     if run_smoothing:
-        # create_susan_smooth refers to FSL's Susan algorithm for smoothing data
-        smooth = create_susan_smooth()
-        
-        # smoothing workflow requires the following inputs:
-            # inputnode.in_files : functional runs (filename or list of filenames)
-            # inputnode.fwhm : fwhm for smoothing with SUSAN
-            # inputnode.mask_file : mask used for estimating SUSAN thresholds (but not for smoothing)
-        
-        # provide smoothing_kernel_size, mask files, and split mni file
-        smooth.inputs.inputnode.fwhm = smoothing_kernel_size
-        wf.connect(datasource, 'mni_mask', smooth, 'inputnode.mask_file')
-        wf.connect(mni_split, 'roi_file', smooth, 'inputnode.in_files')
-
-    # define function to denoise data
-    def denoise_data(imgs, mni_mask, motion_params, vol_indx, outliers, TR, hpf, filter_opt, detrend, standardize,  subDir, sub, run_id, splithalf_id, task):
-        import nibabel as nib
-        from nibabel import load
-        import nilearn
-        from nilearn import image
-        import pandas as pd
-        import numpy as np
-        import os
-        import os.path as op
-        
-        # define run name depending on whether run info is in file name
-        if run_id != 0:
-            run_abrv = 'run{}'.format(run_id)
-            run_full = 'run-{:02d}'.format(run_id)
-        else: # if no run info is in filename, then results are saved under 'run1'
-            run_abrv = 'run1'
-            run_full = 'run-01'
+        # SUSAN (default) or Gaussian smoothing (on the GPU if smooth_backend is 'gpu'), reusing cached outputs if the inputs haven't changed
+        smooth = Node(Function(output_names=['smoothed_file'],
+                               function=smooth_data),
+                               name='smooth', mem_gb=2)
+        smooth.inputs.fwhm = smoothing_kernel_size
+        smooth.inputs.smooth_backend = smooth_backend
+        smooth.inputs.dropvols = dropvols
+        smooth.inputs.cacheDir = op.join(cacheDir, 'smooth_cache')
+        wf.connect(datasource, 'mni_file', smooth, 'mni_file')
+        wf.connect(datasource, 'mni_mask', smooth, 'mask_file')
+        wf.connect(splitdata, 't_min', smooth, 't_min')
+        wf.connect(splitdata, 't_size', smooth, 't_size')
+        wf.connect(mni_split, 'roi_file', smooth, 'in_file')
 
-        # make output directory
-        if splithalf_id != 0:
-            denoiseDir = op.join(subDir, 'denoised', '{}_splithalf{}'.format(run_abrv, splithalf_id))
-            split_name = '_splithalf-{:02d}_'.format(splithalf_id)
-        else:
-            denoiseDir = op.join(subDir, 'denoised', '{}'.format(run_abrv))
-            split_name = '_'
-        
-        os.makedirs(denoiseDir, exist_ok=True)
-     
-        # define output file names depending on whether run info is in file name
-        if run_id != 0:
-            denoise_file = op.join(denoiseDir, 'sub-{}_task-{}_{}{}denoised_bold.nii.gz'.format(sub, task, run_full, split_name))
-            pad_file = op.join(denoiseDir, 'sub-{}_task-{}_{}{}denoised_padded_bold.nii.gz'.format(sub, task, run_full, split_name))
-        
-        else: # if no run info is in filename, then results are saved under 'run1'
-            denoise_file = op.join(denoiseDir, 'sub-{}_task-{}{}denoised_bold.nii.gz'.format(sub, task, split_name))
-            pad_file = op.join(denoiseDir, 'sub-{}_task-{}{}denoised_padded_bold.nii.gz'.format(sub, task, split_name))
-        
-        # the smoothing node returns a list object but clean_img needs a path to the file
-        if isinstance(imgs, list):
-            imgs=imgs[0]        
-        
-        # process options from config file
-        if detrend == 'yes':
-            detrend_opt = True
-        else:
-            detrend_opt = False
-        if standardize != 'no':
-            standardize_opt = standardize
-        else:
-            standardize_opt = False
-            
-        # convert filter from seconds to Hz
-        hpf_hz = 1/hpf
-        
-        print('Will apply a {} filter using a high pass filter cutoff of {}Hz for {}.'.format(filter_opt, hpf_hz, run_full))
-
-        # define kwargs input to signal.clean function
-        if filter_opt == 'butterworth':
-            kwargs_opts={'clean__sample_mask':vol_indx, 
-                         'clean__butterworth__t_r':TR,
-                         'clean__butterworth__high_pass':hpf_hz}
-        elif filter_opt == 'cosine':
-            kwargs_opts={'clean__sample_mask':vol_indx, 
-                         'clean__cosine__t_r':TR,
-                         'clean__cosine__high_pass':hpf_hz}
-        else:
-            kwargs_opts={'clean__sample_mask':vol_indx,
-                         'clean__t_r':TR}
-
-        # process signal data with parameters specified in config file
-        denoised_data = image.clean_img(imgs, mask_img=mni_mask, confounds=motion_params, detrend=detrend_opt, standardize=standardize_opt, **kwargs_opts)
-        
-        # save denoised data
-        nib.save(denoised_data, denoise_file)
-        
-        # load denoised data and extract dimension info
-        denoise_img = image.load_img(denoised_data)
-        img_dim = denoise_img.shape
-        
-        # load input data and extract volume info
-        input_img = image.load_img(imgs)
-        curVols = input_img.shape[3]
-        
-        # create vector of volumes for indexing
-        all_vols_vec = np.arange(curVols, dtype=np.int64)
-        
-        # create nan volume
-        nan_vol = np.empty((img_dim[:-1]))
-        nan_vol[:] = np.nan
-        nan_img = image.new_img_like(denoise_img, nan_vol, affine=denoise_img.affine)
-
-        # pad denoised data with nan vols where vols were scrubbed
-        d=0 # index for denoised data which has a volume for index in vol_indx [curVols - outliers]
-        pad_imgs = list()
-        for vol in all_vols_vec: # for each volume
-            if vol in vol_indx:
-                tmp_vol = image.index_img(denoise_img, d)
-                pad_imgs.append(tmp_vol)
-                d += 1
-            else:
-                tmp_vol = nan_img
-                pad_imgs.append(tmp_vol)
-        
-        # concatente list of 3D imgs to one 4D img
-        pad_concat = image.concat_imgs(pad_imgs)
-       
-        # save padded data
-        nib.save(pad_concat, pad_file)
-        
-        return denoised_data, pad_concat
-    
     # process signal, passing generated confounds
-    cleansignal = Node(Function(output_names=['denoised_data',
-                                              'pad_concat'],
+    # mem_gb estimates let MultiProc pack smoothing and denoising jobs within the memory limit (the 4D run is held in memory several times while denoising)
+    cleansignal = Node(Function(output_names=['denoise_file',
+                                              'pad_file'],
                                 function=denoise_data), 
-                                name='cleansignal')
+                                name='cleansignal', mem_gb=4)
     wf.connect(datasource, 'mni_mask', cleansignal, 'mni_mask')
     wf.connect(splitdata, 'motion_params', cleansignal, 'motion_params')
     wf.connect(splitdata, 'vol_indx', cleansignal, 'vol_indx')
@@ -553,111 +815,20 @@ def create_timecourse_workflow(sharedDir, projDir, derivDir, workDir, outDir, su
     cleansignal.inputs.detrend = detrend
     cleansignal.inputs.standardize = standardize
     cleansignal.inputs.filter_opt = filter_opt
+    # filter coefficients are designed once here (rather than in each run) and passed to the denoising step
+    cleansignal.inputs.filter_sos = highpass_sos(TR, hpf).tolist() if filter_opt == 'butterworth' else None
+    cleansignal.inputs.output_dtype = output_dtype
+    cleansignal.inputs.mask_file = mask_file
     cleansignal.inputs.subDir = subDir
     
     # pass data to cleansignal depending on whether smoothing was requested
     if run_smoothing:
         # pass smoothed output files as functional runs to denoise function
-        wf.connect(smooth, 'outputnode.smoothed_files', cleansignal, 'imgs')
+        wf.connect(smooth, 'smoothed_file', cleansignal, 'imgs')
     else: 
        # pass unsmoothed output files as functional runs to modelspec
         wf.connect(mni_split, 'roi_file', cleansignal, 'imgs')
     
-    def extract_timecourse(denoised_data, pad_concat, roi_masks, mask_opts, extract_opt, outDir, subDir, sub, run_id, splithalf_id, task, nVols, vol_indx):
-        import nibabel as nib
-        from nilearn.maskers import NiftiMasker
-        from nilearn import image
-        import re
-        import os
-        import os.path as op
-        import numpy as np
-        import pandas as pd 
-        
-        # make output directory
-        tcDir = op.join(subDir, 'timecourses')
-        os.makedirs(tcDir, exist_ok=True)
-        
-        # define run name depending on whether run info is in file name
-        if run_id != 0:
-            run_full = 'run-{:02d}'.format(run_id)
-        else: # if no run info is in filename, then results are saved under 'run1'
-            run_full = 'run-01'
-            
-        run_prefix = op.join(tcDir, 'sub-{}_task-{}_{}'.format(sub, task, run_full))
-
-        # extract timecourses for each ROI provided in config file
-        for m, mask in enumerate(roi_masks):
-
-            print('Extracting signal from {} ROI'.format(mask_opts[m]))
-            
-            # ensure that mask/ROI is binarized
-            mask_img = image.load_img(mask)
-            mask_bin = mask_img.get_fdata() # get image data (as floating point data)
-            mask_bin[mask_bin >= 1] = 1 # for values equal to or greater than 1, make 1 (values less than 1 are already 0)
-            mask_bin = image.new_img_like(mask_img, mask_bin) # create a new image of the same class as the initial image
-            
-            # the masks should already be resampled, but check if this is true and resample if not
-            if denoised_data.shape[0:3] != mask_bin.shape[0:3]:
-                print('WARNING: the mask provided has different dimensions than the functional data!')
-                
-                # make directory to save resampled rois
-                roiDir = op.join(outDir, 'resampled_rois')
-                os.makedirs(roiDir, exist_ok=True)
-                
-                # extract file name
-                roi_name = mask[0].split('/')[-1].split('.nii.gz')[0]
-  
-                resampled_file = op.join(roiDir, '{}_resampled.nii.gz'.format(roi_name))
-                
-                # check if file already exists
-                if os.path.isfile(resampled_file):
-                    print('Found previously resampled {} ROI in output directory'.format(mask_opts[m]))
-                    mask_bin = image.load_img(resampled_file)
-                else:
-                    # resample image
-                    print('Resampling {} ROI to match functional data'.format(mask_opts[m]))
-                    mask_bin = image.resample_to_img(mask_bin, denoised_data, interpolation='nearest')
-                    mask_bin.to_filename(resampled_file)
-
-            # instantiate the masker
-            masker = NiftiMasker(mask_img = mask_bin)
-            
-            # apply mask to denoised padded data
-            padded_masked = masker.fit_transform(pad_concat)
-            padded_masked_df = pd.DataFrame(padded_masked)
-            
-            # add splithalf info to output file name     
-            if splithalf_id != 0:
-                if 'fROI' in mask_opts[m]:
-                    # extract fROI name
-                    froi = mask_opts[m].split('_')[0]
-                    
-                    # extract contrast used to generate fROI from file name
-                    contrast = roi_masks[m][0].split('_')[-2]
-                    
-                    # get fROI splithalf info from roi mask and add to output file name
-                    roi_splithalf = re.search('splithalf-(.+?)_', roi_masks[m][0]).group().split('_')[0]
-                                        
-                    tc_prefix = op.join('{}_splithalf-{:02d}_{}-{}-{}'.format(run_prefix, splithalf_id, froi, contrast, roi_splithalf))
-                else:
-                    tc_prefix = op.join('{}_splithalf-{:02d}_{}'.format(run_prefix, splithalf_id, mask_opts[m]))
-            else:
-                tc_prefix = op.join('{}_{}'.format(run_prefix, mask_opts[m]))
-            
-            # average data in mask if requested and add info to output file name
-            if extract_opt == 'mean':
-                # average voxelwise timecourses
-                print('Averging voxelwise timecourses within {} mask'.format(mask_opts[m]))
-                padded_masked_df = padded_masked_df.mean(axis=1).replace([0], np.nan)
-                tc_file = op.join('{}_mean_timecourse.csv'.format(tc_prefix))
-            else:
-                tc_file = op.join('{}_voxelwise_timecourses.csv'.format(tc_prefix))
-            
-            # save file
-            padded_masked_df.to_csv(tc_file, header = False, index=False)
-            
-        return padded_masked
-        
     extractsignal = Node(Function(output_names=['denoised_masked',
                                                 'padded_masked'],
                                   function=extract_timecourse), 
@@ -668,8 +839,8 @@ def create_timecourse_workflow(sharedDir, projDir, derivDir, workDir, outDir, su
     wf.connect(datasource, 'nVols', extractsignal, 'nVols')
     wf.connect(datasource, 'roi_masks', extractsignal, 'roi_masks')
     wf.connect(splitdata, 'vol_indx', extractsignal, 'vol_indx')                                   
-    wf.connect(cleansignal, 'denoised_data', extractsignal, 'denoised_data')
-    wf.connect(cleansignal, 'pad_concat', extractsignal, 'pad_concat')
+    wf.connect(cleansignal, 'denoise_file', extractsignal, 'denoise_file')
+    wf.connect(cleansignal, 'pad_file', extractsignal, 'pad_file')
     extractsignal.inputs.sub = sub
     extractsignal.inputs.task = task
     extractsignal.inputs.outDir = outDir
@@ -691,13 +862,13 @@ def create_timecourse_workflow(sharedDir, projDir, derivDir, workDir, outDir, su
     # define where output files are saved
     wf.connect(mni_split, 'roi_file', sinker, 'preproc.@roi_file')
     if run_smoothing:
-        wf.connect(smooth, 'outputnode.smoothed_files', sinker, 'preproc.@')  
+        wf.connect(smooth, 'smoothed_file', sinker, 'preproc.@')  
         
     return wf
 
 # define function to extract subject-level data for workflow
 def process_subject(layout, sharedDir, projDir, derivDir, outDir, workDir, 
-                    sub, task, ses, ignore_motion, multiecho, sub_runs, regressor_opts, mask_opts, smoothing_kernel_size,resultsDir,smoothDir, hpf, filter_opt, detrend, standardize, template, extract_opt, dropvols, splithalf, space_name):    
+                    sub, task, ses, ignore_motion, multiecho, sub_runs, regressor_opts, mask_opts, smoothing_kernel_size,resultsDir,smoothDir, hpf, filter_opt, detrend, standardize, template, extract_opt, dropvols, splithalf, space_name, smooth_backend, output_dtype, cacheDir, skip_processed):    
     """Grab information and start nipype workflow
     We want to parallelize runs for greater efficiency
     """
@@ -751,11 +922,51 @@ def process_subject(layout, sharedDir, projDir, derivDir, outDir, workDir,
     # if the participant didn't have any runs for this task or all runs were excluded due to motion
     if not keepruns:
         raise FileNotFoundError('No included bold {} runs found for sub-{}'.format(task, sub))
+    
+    # if requested, skip runs (or splithalves) that already have a timecourse file for every mask in the config file (e.g., when rerunning a partially failed batch)
+    if skip_processed == 'yes':
+        tc_suffix = 'mean_timecourse.csv' if extract_opt == 'mean' else 'voxelwise_timecourses.csv'
+        todo = []
+        for r, h in zip(keepruns, splithalves):
+            run_prefix = op.join(subDir, 'timecourses', 'sub-{}_task-{}_run-{:02d}'.format(sub, task, r if r != 0 else 1))
+            tc_patterns = []
+            for m in mask_opts:
+                if h != 0 and 'fROI' in m: # fROI file names include the contrast and splithalf the fROI was defined in
+                    tc_patterns.append('{}_splithalf-{:02d}_{}-*_{}'.format(run_prefix, h, m.split('_')[0], tc_suffix))
+                elif h != 0:
+                    tc_patterns.append('{}_splithalf-{:02d}_{}_{}'.format(run_prefix, h, m, tc_suffix))
+                else:
+                    tc_patterns.append('{}_{}_{}'.format(run_prefix, m, tc_suffix))
+            if all(glob.glob(t) for t in tc_patterns):
+                print('Timecourses already exist for sub-{} run {} (splithalf {}) and will not be extracted again'.format(sub, r, h))
+            else:
+                todo.append((r, h))
+        
+        # return no workflow if all runs were already processed
+        if not todo:
+            print('All {} runs have already been processed for sub-{}'.format(task, sub))
+            return None
+        keepruns, splithalves = [r for r, h in todo], [h for r, h in todo]
    
     # extract TR info from bidsDir bold json files (assumes TR is same across runs)
-    epi = layout.get(subject=sub, suffix='bold', task=task, return_type='file')[0] # take first file
+    epi = layout.get(subject=sub, suffix='bold', task=task, return_type='file')
+    if not epi:
+        raise FileNotFoundError('No {} bold files found for sub-{} in the BIDS layout. If data were added since the layout was saved, set refresh_bids_layout to yes in the config file.'.format(task, sub))
+    epi = epi[0] # take first file
     TR = layout.get_metadata(epi)['RepetitionTime'] # extract TR field
     
+    # the brain mask is the same for all runs (unless multiecho data are used, which have a mask per run), so load it once and save as a boolean array for the denoising step
+    if multiecho != 'yes':
+        if ses != 'no':
+            mni_mask = op.join(derivDir, 'sub-{}'.format(sub), 'ses-{}'.format(ses), 'func', 'sub-{}_ses-{}_space-{}_desc-brain_mask_allruns-BOLDmask.nii.gz'.format(sub, ses, space_name))
+        else:
+            mni_mask = op.join(derivDir, 'sub-{}'.format(sub), 'func', 'sub-{}_space-{}_desc-brain_mask_allruns-BOLDmask.nii.gz'.format(sub, space_name))
+        os.makedirs(workDir, exist_ok=True)
+        mask_file = op.join(workDir, 'sub-{}_task-{}_mask.npy'.format(sub, task))
+        np.save(mask_file, np.asarray(nib.load(mni_mask).dataobj).astype(bool))
+    else:
+        mask_file = None
+    
     # delete prior processing directories because cache files can interfere with workflow
     subworkDir = op.join(workDir, 'sub-{}_task-{}_timecourses'.format(sub, task))
     if os.path.exists(subworkDir):
@@ -763,7 +974,7 @@ def process_subject(layout, sharedDir, projDir, derivDir, outDir, workDir,
 
     # call timecourse workflow with extracted subject-level data
     wf = create_timecourse_workflow(sharedDir, projDir, derivDir, workDir, outDir, subDir, sub,
-                                    task, ses, multiecho, keepruns, regressor_opts, mask_opts, smoothing_kernel_size, resultsDir, smoothDir, hpf, filter_opt, TR, detrend, standardize, template, extract_opt, dropvols, splithalves, space_name)  
+                                    task, ses, multiecho, keepruns, regressor_opts, mask_opts, smoothing_kernel_size, resultsDir, smoothDir, hpf, filter_opt, TR, detrend, standardize, template, extract_opt, dropvols, splithalves, space_name, smooth_backend, output_dtype, mask_file, cacheDir)  
                                     
                                     
     return wf
@@ -789,6 +1000,10 @@ def argparser():
                         help='Specify a sparse model')
     parser.add_argument('-m', dest='plugin',
                         help='Nipype plugin to use (default: MultiProc)')
+    parser.add_argument('-n', dest='n_procs', type=int,
+                        help='Number of processes for MultiProc (default: available cores minus one)')
+    parser.add_argument('-mem', dest='memory_gb', type=float,
+                        help='Memory limit in GB for MultiProc (default: nipype estimate of system memory)')
     return parser
 
 # define main function that parses the config file and runs the functions defined above
@@ -818,6 +1033,7 @@ def main(argv=None):
     ignore_motion=config_file.loc['ignore_motion',1]
     dropvols=int(config_file.loc['dropvols',1])
     smoothing_kernel_size=int(config_file.loc['smoothing',1])
+    smooth_backend=config_file.loc['smooth_backend',1] if 'smooth_backend' in config_file.index else None
     hpf=int(config_file.loc['hpf',1])
     filter_opt=config_file.loc['filter',1]
     detrend=config_file.loc['detrend',1]
@@ -827,8 +1043,11 @@ def main(argv=None):
     splithalf=config_file.loc['splithalf',1]
     template=config_file.loc['template',1]
     extract_opt=config_file.loc['extract',1]
+    output_dtype=config_file.loc['output_dtype',1] if 'output_dtype' in config_file.index else 'float32'
     space=config_file.loc['space',1]
     overwrite=config_file.loc['overwrite',1]
+    skip_processed=config_file.loc['skip_processed',1] if 'skip_processed' in config_file.index else 'no'
+    refresh_bids_layout=config_file.loc['refresh_bids_layout',1] if 'refresh_bids_layout' in config_file.index else 'no'
     
     # print if BIDS directory is not found
     if not op.exists(bidsDir):
@@ -877,7 +1096,8 @@ def main(argv=None):
             os.mkdir(workDir)
         
         # if user requested no overwrite, create new working directory with date and time stamp
-        if (overwrite == 'no') & (len(os.listdir(workDir)) != 0):
+        # unless processed runs should be skipped, in which case the existing directories are reused so previous timecourses can be found
+        if (overwrite == 'no') & (skip_processed != 'yes') & (len(os.listdir(workDir)) != 0):
             print('Creating new output directories to avoid overwriting existing outputs.')
             today = datetime.now() # get date
             datestring = today.strftime('%Y-%m-%d_%H-%M-%S')
@@ -898,9 +1118,19 @@ def main(argv=None):
                 file_2.write(line)
 
     # get layout of BIDS directory
+    # pybids is imported here rather than at the top of the script so MultiProc worker processes don't load it
+    from bids.layout import BIDSLayout
     # this is necessary because the pipeline reads the functional json files that have TR info
     # the derivDir (where fMRIPrep outputs are) doesn't have json files with this information, so getting the layout of that directory will result in an error
-    layout = BIDSLayout(bidsDir)
+    # the layout index is saved to a database directory in the working directory passed in the script call (not the date stamped one) so later runs don't need to index the BIDS directory again
+    # reindex by setting refresh_bids_layout to yes in the config file if data were added to existing subjects
+    layout_db = op.join(op.realpath(args.workDir), 'bids_layout_db')
+    layout = BIDSLayout(bidsDir, database_path=layout_db, reset_database=(refresh_bids_layout == 'yes'))
+    
+    # reindex automatically if any requested subjects are missing from the saved layout (e.g., new subjects were added to the BIDS directory)
+    if args.subjects and not set(args.subjects).issubset(layout.get_subjects()):
+        print('Some requested subjects were not found in the saved BIDS layout. Reindexing the BIDS directory.')
+        layout = BIDSLayout(bidsDir, database_path=layout_db, reset_database=True)
 
     # define subjects - if none are provided in the script call, they are extracted from the BIDS directory layout information
     subjects = args.subjects if args.subjects else layout.get_subjects()
@@ -921,16 +1151,36 @@ def main(argv=None):
               
         # create a process_subject workflow with the inputs defined above
         wf = process_subject(layout, sharedDir, args.projDir, derivDir, outDir, workDir, sub,
-                             task, ses, ignore_motion, multiecho, sub_runs, regressor_opts, mask_opts, smoothing_kernel_size, resultsDir, smoothDir, hpf, filter_opt, detrend, standardize, template, extract_opt, dropvols, splithalf, space_name)
+                             task, ses, ignore_motion, multiecho, sub_runs, regressor_opts, mask_opts, smoothing_kernel_size, resultsDir, smoothDir, hpf, filter_opt, detrend, standardize, template, extract_opt, dropvols, splithalf, space_name, smooth_backend, output_dtype, op.realpath(args.workDir), skip_processed)
    
+        # move on to next subject if there were no runs left to process
+        if wf is None:
+            continue
+        
         # configure workflow options
         wf.config['execution'] = {'crashfile_format': 'txt',
                                   'remove_unnecessary_outputs': False,
                                   'keep_inputs': True}
 
-        # run multiproc
-        args_dict = {'n_procs' : 4}
-        wf.run(plugin='MultiProc', plugin_args = args_dict)
+        # run multiproc unless plugin specified in script call (e.g., SLURM or SLURMGraph to fan runs out across cluster nodes)
+        plugin = args.plugin if args.plugin else 'MultiProc'
+        if plugin == 'MultiProc':
+            # use all cores available to this process (leaving one free) unless the number of processes was specified in script call
+            if args.n_procs:
+                n_procs = args.n_procs
+            elif hasattr(os, 'sched_getaffinity'):
+                n_procs = max(1, len(os.sched_getaffinity(0)) - 1)
+            else:
+                n_procs = max(1, (os.cpu_count() or 2) - 1)
+            # forkserver starts workers from a clean process instead of forking the main process (with its BIDS layout and pandas objects)
+            args_dict = {'n_procs' : n_procs,
+                         'raise_insufficient' : False,
+                         'mp_context' : 'forkserver'}
+            if args.memory_gb:
+                args_dict['memory_gb'] = args.memory_gb
+        else:
+            args_dict = {}
+        wf.run(plugin=plugin, plugin_args = args_dict)
 
 # execute code when file is run as script (the conditional statement is TRUE when script is run in python)
 if __name__ == '__main__':